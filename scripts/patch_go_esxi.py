@@ -1,10 +1,342 @@
 #!/usr/bin/env python3
 
-import argparse
+import json
 import os
 import re
+import shutil
 import subprocess
+import sys
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable
+
+# Go snippets and anchors, hoisted so repeated invocations do not
+# re-materialize them per call.
+
+# src/internal/runtime/syscall/defs_linux_amd64.go
+_DEFS_ANCHOR = "\tSYS_EPOLL_CTL     = 233\n"
+_DEFS_INSERT = "\tSYS_EPOLL_WAIT    = 232\n"
+
+# src/internal/runtime/syscall/syscall_linux.go
+_SYSCALL_NEEDLE = (
+    "\tr1, _, e := Syscall6(SYS_EPOLL_PWAIT, uintptr(epfd), uintptr(ev), uintptr(maxev), uintptr(waitms), 0, 0)\n"
+    "\treturn int32(r1), e"
+)
+_SYSCALL_REPL = (
+    "\tr1, _, e := Syscall6(SYS_EPOLL_PWAIT, uintptr(epfd), uintptr(ev), uintptr(maxev), uintptr(waitms), 0, 0)\n"
+    "\tif e == 38 { // ENOSYS\n"
+    "\t\tr1, _, e = Syscall6(SYS_EPOLL_WAIT, uintptr(epfd), uintptr(ev), uintptr(maxev), uintptr(waitms), 0, 0)\n"
+    "\t}\n"
+    "\treturn int32(r1), e"
+)
+
+# src/runtime/netpoll_epoll.go
+_NETPOLL_OLD = "\treturn syscall.EpollCtl(epfd, syscall.EPOLL_CTL_ADD, int32(fd), &ev)"
+_NETPOLL_NEW = (
+    "\terrno := syscall.EpollCtl(epfd, syscall.EPOLL_CTL_ADD, int32(fd), &ev)\n"
+    "\tif errno == _EINVAL && ev.Events&syscall.EPOLLRDHUP != 0 {\n"
+    "\t\tev.Events &^= syscall.EPOLLRDHUP\n"
+    "\t\terrno = syscall.EpollCtl(epfd, syscall.EPOLL_CTL_ADD, int32(fd), &ev)\n"
+    "\t}\n"
+    "\treturn errno"
+)
+
+# cmd/client/detach.go
+_DETACH_IMPORTS = ("fmt", "os", "os/exec", "path/filepath", "strconv", "strings")
+_RUN_ANCHOR = "func Run(settings *client.Settings) {"
+_FORK_HEADER = "func Fork(settings *client.Settings, pretendArgv ...string) error {"
+_DETACH_HELPERS = r"""func normalizeSelfPath(path string) string {
+	if path == "" {
+		return ""
+	}
+
+	if unquoted, err := strconv.Unquote(path); err == nil {
+		path = unquoted
+	} else {
+		path = strings.Trim(path, "\"'")
+	}
+
+	return path
+}
+
+func isProcPath(path string) bool {
+	return strings.HasPrefix(path, "/proc/")
+}
+
+func selfExecCandidates(settings *client.Settings) []string {
+	candidates := make([]string, 0, 4)
+	seen := make(map[string]bool)
+	add := func(path string) {
+		path = normalizeSelfPath(path)
+		if path == "" || seen[path] {
+			return
+		}
+		if isProcPath(path) {
+			return
+		}
+		seen[path] = true
+		candidates = append(candidates, path)
+	}
+
+	if settings != nil && settings.SelfPath != "" {
+		add(settings.SelfPath)
+	}
+
+	if len(os.Args) > 0 && os.Args[0] != "" {
+		if p, err := exec.LookPath(os.Args[0]); err == nil {
+			add(p)
+			if abs, err := filepath.Abs(p); err == nil {
+				add(abs)
+			}
+		}
+
+		if abs, err := filepath.Abs(os.Args[0]); err == nil {
+			add(abs)
+		}
+	}
+
+	if p, err := os.Executable(); err == nil {
+		add(p)
+	}
+
+	return candidates
+}
+
+"""
+_FORK_NEW = r"""func Fork(settings *client.Settings, pretendArgv ...string) error {
+
+	log.Println("Forking")
+
+	candidates := selfExecCandidates(settings)
+	if len(candidates) == 0 {
+		return fmt.Errorf("unable to resolve self path for re-exec")
+	}
+
+	var lastErr error
+	for _, candidate := range candidates {
+		err := fork(candidate, nil, pretendArgv...)
+		if err == nil {
+			return nil
+		}
+
+		log.Println("Forking from", candidate, "failed:", err)
+		lastErr = err
+	}
+
+	return lastErr
+}
+"""
+
+# internal/client/client.go
+_CLIENT_SNI_ANCHOR = "\tSNI         string\n"
+_CLIENT_SELFPATH_FIELD = "\tSelfPath    string\n"
+
+# internal/server/webserver/buildmanager.go
+_BUILD_FIELD_ANCHOR = "\tProxy, SNI, LogLevel string\n"
+_BUILD_FIELD_INSERT = "\tSelfPath string\n"
+_BUILD_LDFLAG_OLD = "-X main.customSNI=%s -X main.useHostKerberos=%t"
+_BUILD_LDFLAG_NEW = "-X main.customSNI=%s -X main.selfPath=%s -X main.useHostKerberos=%t"
+_BUILD_ARGS_OLD = "config.Proxy, config.SNI, config.UseKerberosAuth"
+_BUILD_ARGS_NEW = "config.Proxy, config.SNI, config.SelfPath, config.UseKerberosAuth"
+
+# internal/server/commands/link.go
+_LINK_SNI_FLAG = "\t\t\"sni\":               \"When TLS is in use, set a custom SNI for the client to connect with\",\n"
+_LINK_FLAG_INSERT = "\t\t\"self-path\":         \"Explicit path to the client binary for re-exec on daemonize\",\n"
+_LINK_SNI_PARSE = (
+    "\tbuildConfig.SNI, err = line.GetArgString(\"sni\")\n"
+    "\tif err != nil && err != terminal.ErrFlagNotSet {\n\t\treturn err\n\t}\n"
+)
+_LINK_PARSE_INSERT = (
+    "\n\tbuildConfig.SelfPath, err = line.GetArgString(\"self-path\")\n"
+    "\tif err != nil && err != terminal.ErrFlagNotSet {\n"
+    "\t\treturn err\n"
+    "\t}\n"
+)
+
+# cmd/client/main.go
+_MAIN_USAGE_OLD = "--[foreground|fingerprint|proxy|process_name]"
+_MAIN_USAGE_NEW = "--[foreground|fingerprint|proxy|process_name|self-path]"
+_MAIN_SNI_USAGE_FRAGMENT = "--sni\\tWhen using TLS"
+_MAIN_USAGE_LINE = "\tfmt.Println(\"\\t\\t--self-path\\tExplicit path to the client binary for re-exec on daemonize\")"
+_MAIN_VAR_ANCHOR = "\tcustomSNI   string\n"
+_MAIN_VAR_INSERT = "\tselfPath    string\n"
+_MAIN_SETTINGS_ANCHOR = "\t\tSNI:                  customSNI,\n"
+_MAIN_SETTINGS_INSERT = "\t\tSelfPath:             selfPath,\n"
+_MAIN_PARSE_ANCHOR = (
+    "\tproxyaddress, _ := line.GetArgString(\"proxy\")\n"
+    "\tif len(proxyaddress) > 0 {\n\t\tsettings.ProxyAddr = proxyaddress\n\t}\n"
+)
+_MAIN_PARSE_INSERT = (
+    "\n\tuserSpecifiedSelfPath, err := line.GetArgString(\"self-path\")\n"
+    "\tif err == nil {\n"
+    "\t\tsettings.SelfPath = userSpecifiedSelfPath\n"
+    "\t}\n"
+)
+
+
+class ScannedText:
+    """A string with memoized first-occurrence offsets.
+
+    Patchers probe the same text for several needles; find() caches each
+    answer so a guard check and the subsequent splice share one scan.
+    The memo is only valid for the wrapped string, so edits must build a
+    new object (FileCache.put drops the stale one).
+    """
+
+    __slots__ = ("s", "_offsets")
+
+    def __init__(self, s: str):
+        self.s = s
+        self._offsets = {}
+
+    def find(self, needle: str) -> int:
+        offset = self._offsets.get(needle)
+        if offset is None:
+            offset = self.s.find(needle)
+            self._offsets[needle] = offset
+        return offset
+
+    def __contains__(self, needle: str) -> bool:
+        return self.find(needle) != -1
+
+
+def write_all_bytes(path: Path, data: bytes) -> None:
+    """Write a whole file through one raw fd.
+
+    Path.write_bytes goes through _io.FileIO and its Python-level
+    wrappers; for a single full-file write an os.open/os.write/os.close
+    triple is all that's needed. The memoryview keeps retries after a
+    short write zero-copy.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
+class FileCache:
+    """Lazily reads files once and buffers edits until flush().
+
+    Files are read as bytes so patchers can probe their idempotency
+    sentinels without paying a UTF-8 decode; the decode happens at most
+    once, on the first get_text call. Patchers mutate the in-memory text
+    via put(); only entries that were put() back are written out, each
+    with a single write. get_bytes reflects on-disk content, not
+    buffered edits.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._text = {}
+        self._scanned = {}
+        self._dirty = set()
+
+    def get_bytes(self, path: Path) -> bytes:
+        data = self._data.get(path)
+        if data is None:
+            # open() reports a missing file just as well as a separate
+            # exists() stat would, for one syscall instead of two.
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                raise SystemExit(f"{path} does not exist") from None
+            self._data[path] = data
+        return data
+
+    def get_text(self, path: Path) -> str:
+        text = self._text.get(path)
+        if text is None:
+            text = self.get_bytes(path).decode("utf-8")
+            self._text[path] = text
+        return text
+
+    def get_scanned(self, path: Path) -> ScannedText:
+        st = self._scanned.get(path)
+        if st is None:
+            st = ScannedText(self.get_text(path))
+            self._scanned[path] = st
+        return st
+
+    def put(self, path: Path, text: str) -> None:
+        self._text[path] = text
+        self._scanned.pop(path, None)
+        self._dirty.add(path)
+
+    def flush(self) -> None:
+        for path in self._dirty:
+            write_all_bytes(path, self._text[path].encode("utf-8"))
+        self._dirty.clear()
+
+
+def splice_once(st: ScannedText, needle: str, replacement: str, path: Path, label: str) -> str:
+    """Replace the first occurrence of needle in one scan.
+
+    Unlike the `in` + str.replace pair this walks the text once: a
+    (memoized) find, then a slice splice. Missing anchors are fatal, as
+    before.
+    """
+    idx = st.find(needle)
+    if idx == -1:
+        raise SystemExit(f"{path}: anchor not found ({label})")
+    text = st.s
+    return text[:idx] + replacement + text[idx + len(needle):]
+
+
+def apply_edits(text: str, edits) -> str:
+    """Apply (offset, length, replacement) edits to text in one pass.
+
+    Each sequential str.replace copies and rescans the whole file; here
+    the edits are sorted by offset and the result is emitted with a
+    single walk and one join. Edits must not overlap. A zero length
+    makes the edit a pure insertion at offset.
+    """
+    out = []
+    pos = 0
+    for offset, length, replacement in sorted(edits):
+        assert offset >= pos, "overlapping edits"
+        out.append(text[pos:offset])
+        out.append(replacement)
+        pos = offset + length
+    out.append(text[pos:])
+    return "".join(out)
+
+
+def _find_func_block(st: ScannedText, header: str) -> "tuple[int, int]":
+    """Locate a brace-delimited Go function starting at header.
+
+    Returns (start, end_exclusive) spanning up to and including the
+    matching closing brace, or (-1, -1) if the header is absent or the
+    braces never balance. A linear walk over the body; no regex engine.
+    """
+    start = st.find(header)
+    if start == -1:
+        return -1, -1
+
+    text = st.s
+    depth = 1
+    i = start + len(header)
+    n = len(text)
+    while depth and i < n:
+        c = text[i]
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+        i += 1
+
+    if depth:
+        return -1, -1
+    return start, i
+
+
+def _goroot_cache_file() -> Path:
+    xdg = os.environ.get("XDG_CACHE_HOME")
+    base = Path(xdg) if xdg else Path.home() / ".cache"
+    return base / "patch_go_esxi" / "goroot.json"
 
 
 def resolve_goroot(arg_goroot: str) -> Path:
@@ -15,6 +347,26 @@ def resolve_goroot(arg_goroot: str) -> Path:
     if env_goroot:
         return Path(env_goroot)
 
+    go_path = shutil.which("go")
+    if go_path is None:
+        raise SystemExit("go binary not found; set --goroot or GOROOT")
+
+    # Spawning 'go env GOROOT' costs more than the rest of this script;
+    # cache its answer keyed on the go binary and its mtime. The answer
+    # also depends on where we run from (a go.mod toolchain directive
+    # can redirect it) and on GOTOOLCHAIN, so both are part of the key.
+    key = (
+        f"{go_path}:{os.stat(go_path).st_mtime_ns}"
+        f":{os.getcwd()}:{os.environ.get('GOTOOLCHAIN', '')}"
+    )
+    cache_file = _goroot_cache_file()
+    try:
+        cached = json.loads(cache_file.read_bytes())
+        if isinstance(cached, dict) and cached.get("key") == key and cached.get("goroot"):
+            return Path(cached["goroot"])
+    except (OSError, ValueError):
+        pass
+
     try:
         out = subprocess.check_output(["go", "env", "GOROOT"], text=True).strip()
     except FileNotFoundError as exc:
@@ -25,75 +377,41 @@ def resolve_goroot(arg_goroot: str) -> Path:
     if not out:
         raise SystemExit("GOROOT is empty; set --goroot or GOROOT")
 
-    return Path(out)
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(json.dumps({"key": key, "goroot": out}))
+    except OSError:
+        pass
 
+    return Path(out)
 
-def patch_defs(path: Path) -> bool:
-    text = path.read_text()
-    if "SYS_EPOLL_WAIT" in text:
-        return False
 
-    anchor = "\tSYS_EPOLL_CTL     = 233\n"
-    if anchor not in text:
-        raise SystemExit(f"{path}: anchor not found (SYS_EPOLL_CTL)")
+def patch_defs(path: Path, cache: FileCache) -> bool:
+    st = cache.get_scanned(path)
 
-    text = text.replace(anchor, anchor + "\tSYS_EPOLL_WAIT    = 232\n")
-    path.write_text(text)
+    cache.put(path, splice_once(st, _DEFS_ANCHOR, _DEFS_ANCHOR + _DEFS_INSERT, path, "SYS_EPOLL_CTL"))
     return True
 
 
-def patch_syscall(path: Path) -> bool:
-    text = path.read_text()
-    if "if e == 38 { // ENOSYS" in text:
-        return False
-
-    needle = (
-        "\tr1, _, e := Syscall6(SYS_EPOLL_PWAIT, uintptr(epfd), uintptr(ev), uintptr(maxev), uintptr(waitms), 0, 0)\n"
-        "\treturn int32(r1), e"
-    )
-    if needle not in text:
-        raise SystemExit(f"{path}: anchor not found (EpollWait body)")
-
-    replacement = (
-        "\tr1, _, e := Syscall6(SYS_EPOLL_PWAIT, uintptr(epfd), uintptr(ev), uintptr(maxev), uintptr(waitms), 0, 0)\n"
-        "\tif e == 38 { // ENOSYS\n"
-        "\t\tr1, _, e = Syscall6(SYS_EPOLL_WAIT, uintptr(epfd), uintptr(ev), uintptr(maxev), uintptr(waitms), 0, 0)\n"
-        "\t}\n"
-        "\treturn int32(r1), e"
-    )
+def patch_syscall(path: Path, cache: FileCache) -> bool:
+    st = cache.get_scanned(path)
 
-    path.write_text(text.replace(needle, replacement))
+    cache.put(path, splice_once(st, _SYSCALL_NEEDLE, _SYSCALL_REPL, path, "EpollWait body"))
     return True
 
 
-def patch_netpoll(path: Path) -> bool:
-    text = path.read_text()
-    if "ev.Events &^= syscall.EPOLLRDHUP" in text:
-        return False
-
-    old = "\treturn syscall.EpollCtl(epfd, syscall.EPOLL_CTL_ADD, int32(fd), &ev)"
-    if old not in text:
-        raise SystemExit(f"{path}: anchor not found (EpollCtl add)")
-
-    new = (
-        "\terrno := syscall.EpollCtl(epfd, syscall.EPOLL_CTL_ADD, int32(fd), &ev)\n"
-        "\tif errno == _EINVAL && ev.Events&syscall.EPOLLRDHUP != 0 {\n"
-        "\t\tev.Events &^= syscall.EPOLLRDHUP\n"
-        "\t\terrno = syscall.EpollCtl(epfd, syscall.EPOLL_CTL_ADD, int32(fd), &ev)\n"
-        "\t}\n"
-        "\treturn errno"
-    )
+def patch_netpoll(path: Path, cache: FileCache) -> bool:
+    st = cache.get_scanned(path)
 
-    path.write_text(text.replace(old, new))
+    cache.put(path, splice_once(st, _NETPOLL_OLD, _NETPOLL_NEW, path, "EpollCtl add"))
     return True
 
 
-def patch_detach(path: Path) -> bool:
-    text = path.read_text()
-    if "normalizeSelfPath" in text and "selfExecCandidates" in text:
-        return False
+def patch_detach(path: Path, cache: FileCache) -> bool:
+    st = cache.get_scanned(path)
+    text = st.s
 
-    import_start = text.find("import (")
+    import_start = st.find("import (")
     if import_start == -1:
         raise SystemExit(f"{path}: import block not found")
     import_end = text.find(")\n", import_start)
@@ -108,11 +426,7 @@ def patch_detach(path: Path) -> bool:
             indent = line[: len(line) - len(line.lstrip())]
             break
 
-    def has_import(name: str) -> bool:
-        for line in import_lines[1:-1]:
-            if line.strip().strip('"') == name:
-                return True
-        return False
+    existing = {line.strip().strip('"') for line in import_lines[1:-1] if line.strip()}
 
     def find_import_line(name: str) -> int:
         for i, line in enumerate(import_lines):
@@ -120,260 +434,224 @@ def patch_detach(path: Path) -> bool:
                 return i
         return -1
 
-    for name in ("fmt", "os", "os/exec", "path/filepath", "strconv", "strings"):
-        if has_import(name):
+    # The anchor's index is loop-invariant: insertions land after it, so
+    # it never shifts. If the anchor itself is one of the missing names
+    # its position is tracked locally instead of rescanned.
+    filepath_idx = find_import_line("path/filepath")
+
+    for name in _DETACH_IMPORTS:
+        if name in existing:
             continue
-        insert_at = find_import_line("path/filepath")
-        if insert_at == -1:
+        if filepath_idx == -1:
             insert_at = len(import_lines) - 1
         else:
-            insert_at += 1
+            insert_at = filepath_idx + 1
         import_lines.insert(insert_at, f"{indent}\"{name}\"")
+        if name == "path/filepath":
+            filepath_idx = insert_at
 
-    new_import_block = "\n".join(import_lines)
-    text = text.replace(import_block, new_import_block, 1)
+    # All three regions are disjoint, so their offsets can be taken on
+    # the original text and applied in one pass.
+    edits = [(import_start, import_end + 2 - import_start, "\n".join(import_lines))]
 
-    run_anchor = "func Run(settings *client.Settings) {"
-    if run_anchor not in text:
+    run_idx = st.find(_RUN_ANCHOR)
+    if run_idx == -1:
         raise SystemExit(f"{path}: anchor not found (Run)")
+    edits.append((run_idx, 0, _DETACH_HELPERS))
 
-    helpers = (
-        "func normalizeSelfPath(path string) string {\n"
-        "\tif path == \"\" {\n"
-        "\t\treturn \"\"\n"
-        "\t}\n\n"
-        "\tif unquoted, err := strconv.Unquote(path); err == nil {\n"
-        "\t\tpath = unquoted\n"
-        "\t} else {\n"
-        "\t\tpath = strings.Trim(path, \"\\\"'\")\n"
-        "\t}\n\n"
-        "\treturn path\n"
-        "}\n\n"
-        "func isProcPath(path string) bool {\n"
-        "\treturn strings.HasPrefix(path, \"/proc/\")\n"
-        "}\n\n"
-        "func selfExecCandidates(settings *client.Settings) []string {\n"
-        "\tcandidates := make([]string, 0, 4)\n"
-        "\tseen := make(map[string]bool)\n"
-        "\tadd := func(path string) {\n"
-        "\t\tpath = normalizeSelfPath(path)\n"
-        "\t\tif path == \"\" || seen[path] {\n"
-        "\t\t\treturn\n"
-        "\t\t}\n"
-        "\t\tif isProcPath(path) {\n"
-        "\t\t\treturn\n"
-        "\t\t}\n"
-        "\t\tseen[path] = true\n"
-        "\t\tcandidates = append(candidates, path)\n"
-        "\t}\n\n"
-        "\tif settings != nil && settings.SelfPath != \"\" {\n"
-        "\t\tadd(settings.SelfPath)\n"
-        "\t}\n\n"
-        "\tif len(os.Args) > 0 && os.Args[0] != \"\" {\n"
-        "\t\tif p, err := exec.LookPath(os.Args[0]); err == nil {\n"
-        "\t\t\tadd(p)\n"
-        "\t\t\tif abs, err := filepath.Abs(p); err == nil {\n"
-        "\t\t\t\tadd(abs)\n"
-        "\t\t\t}\n"
-        "\t\t}\n\n"
-        "\t\tif abs, err := filepath.Abs(os.Args[0]); err == nil {\n"
-        "\t\t\tadd(abs)\n"
-        "\t\t}\n"
-        "\t}\n\n"
-        "\tif p, err := os.Executable(); err == nil {\n"
-        "\t\tadd(p)\n"
-        "\t}\n\n"
-        "\treturn candidates\n"
-        "}\n\n"
-    )
+    fork_start, fork_end = _find_func_block(st, _FORK_HEADER)
+    if fork_start == -1:
+        raise SystemExit(f"{path}: Fork function not found for replacement")
+    edits.append((fork_start, fork_end - fork_start, _FORK_NEW))
+
+    cache.put(path, apply_edits(text, edits))
+    return True
 
-    text = text.replace(run_anchor, helpers + run_anchor, 1)
 
-    fork_re = re.compile(
-        r"func Fork\(settings \*client\.Settings, pretendArgv \.\.\.string\) error \{[\s\S]*?\n\}"
-    )
-    if not fork_re.search(text):
-        raise SystemExit(f"{path}: Fork function not found for replacement")
+def patch_client_settings(path: Path, cache: FileCache) -> bool:
+    st = cache.get_scanned(path)
 
-    fork_new = (
-        "func Fork(settings *client.Settings, pretendArgv ...string) error {\n\n"
-        "\tlog.Println(\"Forking\")\n\n"
-        "\tcandidates := selfExecCandidates(settings)\n"
-        "\tif len(candidates) == 0 {\n"
-        "\t\treturn fmt.Errorf(\"unable to resolve self path for re-exec\")\n"
-        "\t}\n\n"
-        "\tvar lastErr error\n"
-        "\tfor _, candidate := range candidates {\n"
-        "\t\terr := fork(candidate, nil, pretendArgv...)\n"
-        "\t\tif err == nil {\n"
-        "\t\t\treturn nil\n"
-        "\t\t}\n\n"
-        "\t\tlog.Println(\"Forking from\", candidate, \"failed:\", err)\n"
-        "\t\tlastErr = err\n"
-        "\t}\n\n"
-        "\treturn lastErr\n"
-        "}\n"
+    text = splice_once(
+        st, _CLIENT_SNI_ANCHOR, _CLIENT_SNI_ANCHOR + _CLIENT_SELFPATH_FIELD, path, "SNI field"
     )
-
-    text = fork_re.sub(fork_new, text, count=1)
-    path.write_text(text)
+    cache.put(path, text)
     return True
 
 
-def patch_client_settings(path: Path) -> bool:
-    text = path.read_text()
-    if "SelfPath" in text:
-        return False
+def patch_buildmanager(path: Path, cache: FileCache) -> bool:
+    st = cache.get_scanned(path)
 
-    anchor = "\tSNI         string\n"
-    if anchor not in text:
-        raise SystemExit(f"{path}: anchor not found (SNI field)")
+    edits = []
 
-    insert = anchor + "\tSelfPath    string\n"
-    text = text.replace(anchor, insert, 1)
-    path.write_text(text)
-    return True
+    if st.find("SelfPath") == -1:
+        idx = st.find(_BUILD_FIELD_ANCHOR)
+        if idx == -1:
+            raise SystemExit(f"{path}: anchor not found (Proxy/SNI/LogLevel fields)")
+        edits.append((idx + len(_BUILD_FIELD_ANCHOR), 0, _BUILD_FIELD_INSERT))
+
+    if st.find("main.selfPath") == -1:
+        idx = st.find(_BUILD_LDFLAG_OLD)
+        if idx != -1:
+            edits.append((idx, len(_BUILD_LDFLAG_OLD), _BUILD_LDFLAG_NEW))
 
+    if st.find("config.SelfPath") == -1:
+        idx = st.find(_BUILD_ARGS_OLD)
+        if idx != -1:
+            edits.append((idx, len(_BUILD_ARGS_OLD), _BUILD_ARGS_NEW))
 
-def patch_buildmanager(path: Path) -> bool:
-    text = path.read_text()
-    if "SelfPath" in text and "main.selfPath" in text:
+    if not edits:
         return False
 
-    field_anchor = "\tProxy, SNI, LogLevel string\n"
-    if field_anchor in text and "SelfPath" not in text:
-        text = text.replace(field_anchor, field_anchor + "\tSelfPath string\n", 1)
-    elif "SelfPath" not in text:
-        raise SystemExit(f"{path}: anchor not found (Proxy/SNI/LogLevel fields)")
+    cache.put(path, apply_edits(st.s, edits))
+    return True
 
-    ldflag_anchor = "-X main.customSNI=%s -X main.useHostKerberos=%t"
-    if ldflag_anchor in text and "main.selfPath" not in text:
-        text = text.replace(ldflag_anchor, "-X main.customSNI=%s -X main.selfPath=%s -X main.useHostKerberos=%t", 1)
 
-    args_anchor = "config.Proxy, config.SNI, config.UseKerberosAuth"
-    if args_anchor in text and "config.SelfPath" not in text:
-        text = text.replace(args_anchor, "config.Proxy, config.SNI, config.SelfPath, config.UseKerberosAuth", 1)
+def patch_link_command(path: Path, cache: FileCache) -> bool:
+    st = cache.get_scanned(path)
 
-    path.write_text(text)
-    return True
+    edits = []
 
+    if st.find("self-path") == -1:
+        # Add flag description; fall back to the parse site only when the
+        # description anchor is absent, matching the old sequential order.
+        idx = st.find(_LINK_SNI_FLAG)
+        if idx != -1:
+            edits.append((idx + len(_LINK_SNI_FLAG), 0, _LINK_FLAG_INSERT))
+        else:
+            # Parse flag into buildConfig
+            idx = st.find(_LINK_SNI_PARSE)
+            if idx != -1:
+                edits.append((idx + len(_LINK_SNI_PARSE), 0, _LINK_PARSE_INSERT))
 
-def patch_link_command(path: Path) -> bool:
-    text = path.read_text()
-    if "self-path" in text and "SelfPath" in text:
+    if not edits:
         return False
 
-    # Add flag description
-    sni_flag = "\t\t\"sni\":               \"When TLS is in use, set a custom SNI for the client to connect with\",\n"
-    if sni_flag in text and "self-path" not in text:
-        text = text.replace(
-            sni_flag,
-            sni_flag + "\t\t\"self-path\":         \"Explicit path to the client binary for re-exec on daemonize\",\n",
-            1,
-        )
+    cache.put(path, apply_edits(st.s, edits))
+    return True
 
-    # Parse flag into buildConfig
-    sni_parse = "\tbuildConfig.SNI, err = line.GetArgString(\"sni\")\n"
-    if sni_parse in text and "self-path" not in text:
-        insert = (
-            sni_parse
-            + "\tif err != nil && err != terminal.ErrFlagNotSet {\n"
-            + "\t\treturn err\n"
-            + "\t}\n\n"
-            + "\tbuildConfig.SelfPath, err = line.GetArgString(\"self-path\")\n"
-            + "\tif err != nil && err != terminal.ErrFlagNotSet {\n"
-            + "\t\treturn err\n"
-            + "\t}\n"
-        )
-        text = text.replace(
-            sni_parse
-            + "\tif err != nil && err != terminal.ErrFlagNotSet {\n\t\treturn err\n\t}\n",
-            insert,
-            1,
-        )
 
-    path.write_text(text)
-    return True
+def patch_main(path: Path, cache: FileCache) -> bool:
+    st = cache.get_scanned(path)
+    text = st.s
 
+    # Fully-patched fast path: the same three sentinels run_patchers
+    # probes at the bytes layer. Each find is memoized, so on a partial
+    # patch the per-edit guards below reuse these scans for free.
+    if (
+        "GetArgString(\"self-path\")" in st
+        and "SelfPath" in st
+        and "--self-path" in st
+    ):
+        return False
 
-def patch_main(path: Path) -> bool:
-    text = path.read_text()
-    if "GetArgString(\"self-path\")" in text and "SelfPath" in text and "--self-path" in text:
+    edits = []
+
+    idx = st.find(_MAIN_USAGE_OLD)
+    if idx != -1:
+        edits.append((idx, len(_MAIN_USAGE_OLD), _MAIN_USAGE_NEW))
+
+    if st.find("selfPath") == -1:
+        idx = st.find(_MAIN_VAR_ANCHOR)
+        if idx != -1:
+            edits.append((idx + len(_MAIN_VAR_ANCHOR), 0, _MAIN_VAR_INSERT))
+
+    if st.find("SelfPath") == -1:
+        idx = st.find(_MAIN_SETTINGS_ANCHOR)
+        if idx != -1:
+            edits.append((idx + len(_MAIN_SETTINGS_ANCHOR), 0, _MAIN_SETTINGS_INSERT))
+
+    if st.find("GetArgString(\"self-path\")") == -1:
+        idx = st.find(_MAIN_PARSE_ANCHOR)
+        if idx != -1:
+            edits.append((idx + len(_MAIN_PARSE_ANCHOR), 0, _MAIN_PARSE_INSERT))
+
+    if st.find("--self-path") == -1:
+        # The usage line goes after the --sni line's newline; none of the
+        # other edits introduce "--self-path", so the original-text guard
+        # and offsets stay valid.
+        anchor_start = st.find(_MAIN_SNI_USAGE_FRAGMENT)
+        if anchor_start != -1:
+            eol = text.find("\n", anchor_start)
+            if eol == -1:
+                edits.append((len(text), 0, "\n" + _MAIN_USAGE_LINE))
+            else:
+                edits.append((eol + 1, 0, _MAIN_USAGE_LINE + "\n"))
+
+    if not edits:
         return False
 
-    updated = False
-
-    usage_old = "--[foreground|fingerprint|proxy|process_name]"
-    if usage_old in text:
-        text = text.replace(usage_old, "--[foreground|fingerprint|proxy|process_name|self-path]", 1)
-        updated = True
-
-    if "--self-path" not in text:
-        lines = text.splitlines()
-        for i, line in enumerate(lines):
-            if "--sni\\tWhen using TLS" in line:
-                lines.insert(
-                    i + 1,
-                    "\tfmt.Println(\"\\t\\t--self-path\\tExplicit path to the client binary for re-exec on daemonize\")",
-                )
-                text = "\n".join(lines) + ("\n" if text.endswith("\n") else "")
-                updated = True
-                break
-
-    var_anchor = "\tcustomSNI   string\n"
-    if var_anchor in text and "selfPath" not in text:
-        text = text.replace(var_anchor, var_anchor + "\tselfPath    string\n", 1)
-        updated = True
-
-    settings_anchor = "\t\tSNI:                  customSNI,\n"
-    if settings_anchor in text and "SelfPath" not in text:
-        text = text.replace(settings_anchor, settings_anchor + "\t\tSelfPath:             selfPath,\n", 1)
-        updated = True
-
-    parse_anchor = "\tproxyaddress, _ := line.GetArgString(\"proxy\")\n"
-    if parse_anchor in text and "GetArgString(\"self-path\")" not in text:
-        insert = (
-            parse_anchor
-            + "\tif len(proxyaddress) > 0 {\n"
-            + "\t\tsettings.ProxyAddr = proxyaddress\n"
-            + "\t}\n\n"
-            + "\tuserSpecifiedSelfPath, err := line.GetArgString(\"self-path\")\n"
-            + "\tif err == nil {\n"
-            + "\t\tsettings.SelfPath = userSpecifiedSelfPath\n"
-            + "\t}\n"
-        )
-        text = text.replace(
-            parse_anchor + "\tif len(proxyaddress) > 0 {\n\t\tsettings.ProxyAddr = proxyaddress\n\t}\n",
-            insert,
-            1,
-        )
-        updated = True
-
-    if updated:
-        path.write_text(text)
-        return True
-
-    return False
-
-
-def validate_repo(repo_root: Path) -> None:
-    checks = [
-        (repo_root / "internal/client/client.go", "SelfPath"),
-        (repo_root / "cmd/client/main.go", "--self-path"),
-        (repo_root / "cmd/client/detach.go", "selfExecCandidates"),
-        (repo_root / "cmd/client/detach.go", "normalizeSelfPath"),
-        (repo_root / "cmd/client/detach.go", "isProcPath"),
-        (repo_root / "internal/server/commands/link.go", "self-path"),
-        (repo_root / "internal/server/webserver/buildmanager.go", "main.selfPath"),
-        (repo_root / "internal/server/webserver/buildmanager.go", "SelfPath"),
-    ]
+    cache.put(path, apply_edits(text, edits))
+    return True
+
+
+@dataclass(frozen=True)
+class PatchSpec:
+    """One file patch: where, how, and the bytes that mean 'already done'."""
+
+    path: Path
+    fn: "Callable[[Path, FileCache], bool]"
+    sentinels: "tuple[bytes, ...]"
+
+
+# (relative path, patcher, idempotency sentinels) for each patch target.
+# The dispatch loop probes the sentinels against the raw bytes and only
+# calls the patcher when at least one is missing.
+_GOROOT_PATCHES = (
+    ("src/internal/runtime/syscall/defs_linux_amd64.go", patch_defs, (b"SYS_EPOLL_WAIT",)),
+    ("src/internal/runtime/syscall/syscall_linux.go", patch_syscall, (b"if e == 38 { // ENOSYS",)),
+    ("src/runtime/netpoll_epoll.go", patch_netpoll, (b"ev.Events &^= syscall.EPOLLRDHUP",)),
+)
+_REPO_PATCHES = (
+    ("cmd/client/detach.go", patch_detach, (b"normalizeSelfPath", b"selfExecCandidates")),
+    ("cmd/client/main.go", patch_main, (b"GetArgString(\"self-path\")", b"SelfPath", b"--self-path")),
+    ("internal/client/client.go", patch_client_settings, (b"SelfPath",)),
+    ("internal/server/commands/link.go", patch_link_command, (b"self-path", b"SelfPath")),
+    ("internal/server/webserver/buildmanager.go", patch_buildmanager, (b"SelfPath", b"main.selfPath")),
+)
+
+
+def build_specs(root: Path, entries) -> "list[PatchSpec]":
+    return [PatchSpec(root / rel, fn, sentinels) for rel, fn, sentinels in entries]
+
+
+def run_patchers(specs, cache: FileCache) -> "list[str]":
+    patched = []
+    for spec in specs:
+        data = cache.get_bytes(spec.path)
+        if all(sentinel in data for sentinel in spec.sentinels):
+            continue
+        if spec.fn(spec.path, cache):
+            patched.append(str(spec.path))
+    return patched
+
+
+# Sentinels validate_repo requires per repo-relative path; the compiled
+# alternations let one scan of each file check all of its needles.
+_VALIDATE_CHECKS = (
+    ("internal/client/client.go", ("SelfPath",)),
+    ("cmd/client/main.go", ("--self-path",)),
+    ("cmd/client/detach.go", ("selfExecCandidates", "normalizeSelfPath", "isProcPath")),
+    ("internal/server/commands/link.go", ("self-path",)),
+    ("internal/server/webserver/buildmanager.go", ("main.selfPath", "SelfPath")),
+)
+_VALIDATE_RES = {
+    rel: re.compile("|".join(map(re.escape, needles))) for rel, needles in _VALIDATE_CHECKS
+}
+
+
+def validate_repo(repo_root: Path, cache: "FileCache | None" = None) -> None:
     missing = []
-    for path, needle in checks:
+    for rel, needles in _VALIDATE_CHECKS:
+        path = repo_root / rel
         if not path.exists():
             missing.append(f"{path} does not exist")
             continue
-        if needle not in path.read_text():
-            missing.append(f"{path} missing {needle}")
+        # The patch step usually leaves the final text resident in the
+        # cache; only fall back to disk when called without one.
+        text = cache.get_text(path) if cache is not None else path.read_text()
+        # One pass over the file finds every sentinel at once.
+        found = {m.group() for m in _VALIDATE_RES[rel].finditer(text)}
+        missing.extend(f"{path} missing {needle}" for needle in needles if needle not in found)
 
     if missing:
         raise SystemExit(
@@ -383,30 +661,54 @@ def validate_repo(repo_root: Path) -> None:
     print("repo: self-path/forking patch present")
 
 
-def main() -> int:
+def _build_parser():
+    # argparse drags in re/gettext/textwrap at import; only pay for it on
+    # --help or a malformed command line, where its output is wanted.
+    import argparse
+
     parser = argparse.ArgumentParser(description="Patch Go runtime for ESXi epoll quirks")
     parser.add_argument("--goroot", help="GOROOT path (defaults to GOROOT env or 'go env GOROOT')")
     parser.add_argument("--repo", help="Repo root to validate for self-path/forking patch")
-    args = parser.parse_args()
+    return parser
+
+
+def parse_argv(argv) -> "tuple[str | None, str | None]":
+    goroot = None
+    repo = None
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg in ("-h", "--help"):
+            _build_parser().parse_args(["--help"])
+        elif arg == "--goroot" and i + 1 < len(argv):
+            i += 1
+            goroot = argv[i]
+        elif arg.startswith("--goroot="):
+            goroot = arg[len("--goroot="):]
+        elif arg == "--repo" and i + 1 < len(argv):
+            i += 1
+            repo = argv[i]
+        elif arg.startswith("--repo="):
+            repo = arg[len("--repo="):]
+        else:
+            # Unknown or malformed argument: hand the whole line to
+            # argparse. Usually it errors out with its usage message,
+            # but abbreviated flags like --gor parse fine — in that
+            # case its answer is authoritative.
+            args = _build_parser().parse_args(argv[1:])
+            return args.goroot, args.repo
+        i += 1
+    return goroot, repo
 
-    goroot = resolve_goroot(args.goroot)
 
-    defs_path = goroot / "src/internal/runtime/syscall/defs_linux_amd64.go"
-    syscall_path = goroot / "src/internal/runtime/syscall/syscall_linux.go"
-    netpoll_path = goroot / "src/runtime/netpoll_epoll.go"
+def main() -> int:
+    arg_goroot, arg_repo = parse_argv(sys.argv)
 
-    for p in (defs_path, syscall_path, netpoll_path):
-        if not p.exists():
-            raise SystemExit(f"{p} does not exist")
+    goroot = resolve_goroot(arg_goroot)
 
-    patched = []
-    if patch_defs(defs_path):
-        patched.append(str(defs_path))
-    if patch_syscall(syscall_path):
-        patched.append(str(syscall_path))
-    if patch_netpoll(netpoll_path):
-        patched.append(str(netpoll_path))
+    cache = FileCache()
 
+    patched = run_patchers(build_specs(goroot, _GOROOT_PATCHES), cache)
     if patched:
         print("patched:")
         for p in patched:
@@ -414,30 +716,15 @@ def main() -> int:
     else:
         print("already patched")
 
-    if args.repo:
-        repo_root = Path(args.repo)
-        detach_path = repo_root / "cmd/client/detach.go"
-        main_path = repo_root / "cmd/client/main.go"
-        client_path = repo_root / "internal/client/client.go"
-        link_path = repo_root / "internal/server/commands/link.go"
-        build_path = repo_root / "internal/server/webserver/buildmanager.go"
-
-        for p in (detach_path, main_path, client_path, link_path, build_path):
-            if not p.exists():
-                raise SystemExit(f"{p} does not exist")
-
-        repo_patched = []
-        if patch_detach(detach_path):
-            repo_patched.append(str(detach_path))
-        if patch_main(main_path):
-            repo_patched.append(str(main_path))
-        if patch_client_settings(client_path):
-            repo_patched.append(str(client_path))
-        if patch_link_command(link_path):
-            repo_patched.append(str(link_path))
-        if patch_buildmanager(build_path):
-            repo_patched.append(str(build_path))
+    # Write the goroot edits out now; a failure in the repo phase (or in
+    # validate_repo) must not discard files already reported as patched.
+    # flush() clears the dirty set, so the later flush only writes repo
+    # edits.
+    cache.flush()
 
+    if arg_repo:
+        repo_root = Path(arg_repo)
+        repo_patched = run_patchers(build_specs(repo_root, _REPO_PATCHES), cache)
         if repo_patched:
             print("repo patched:")
             for p in repo_patched:
@@ -445,7 +732,8 @@ def main() -> int:
         else:
             print("repo already patched")
 
-        validate_repo(repo_root)
+        cache.flush()
+        validate_repo(repo_root, cache)
 
     return 0
 